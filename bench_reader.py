@@ -0,0 +1,79 @@
+# Offline benchmark of ERA5WindowReader against a synthetic store with the get_era5.py layout
+import time
+import argparse
+import tempfile
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+from utils.era5_reader import ERA5WindowReader
+
+
+def make_synthetic_store(zarr_path, num_times, num_levels, num_lat, num_lon):
+    times = pd.date_range('2020-01-01', periods=num_times, freq='6h')
+    level = np.linspace(1000, 50, num_levels).astype(np.int64)
+    latitude  = np.linspace(90, -90, num_lat)
+    longitude = np.linspace(0, 360, num_lon, endpoint=False)
+
+    rng = np.random.default_rng(0)
+    ds = xr.Dataset(
+        {
+            'temperature': (('time', 'level', 'latitude', 'longitude'),
+                            rng.standard_normal((num_times, num_levels, num_lat, num_lon), dtype=np.float32)),
+            'geopotential': (('time', 'level', 'latitude', 'longitude'),
+                             rng.standard_normal((num_times, num_levels, num_lat, num_lon), dtype=np.float32)),
+            '2m_temperature': (('time', 'latitude', 'longitude'),
+                               rng.standard_normal((num_times, num_lat, num_lon), dtype=np.float32)),
+        },
+        coords={'time': times, 'level': level, 'latitude': latitude, 'longitude': longitude},
+    )
+    ds = ds.chunk({'time': 1, 'latitude': -1, 'longitude': -1, 'level': -1})
+    ds.to_zarr(zarr_path, mode='w', consolidated=True)
+
+
+def naive_loop(zarr_path, history_length, lead_time):
+    ds = xr.open_zarr(zarr_path)
+    num_times = ds.sizes['time']
+    start_time = time.perf_counter()
+    num_samples = 0
+    for anchor in range(history_length - 1, num_times - lead_time):
+        ds.isel(time=slice(anchor - history_length + 1, anchor + 1)).load()
+        ds.isel(time=slice(anchor + lead_time, anchor + lead_time + 1)).load()
+        num_samples += 1
+    return num_samples / (time.perf_counter() - start_time)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--times', type=int, default=64)
+    parser.add_argument('--levels', type=int, default=13)
+    parser.add_argument('--lat', type=int, default=181)
+    parser.add_argument('--lon', type=int, default=360)
+    parser.add_argument('--history', type=int, default=2)
+    parser.add_argument('--lead', type=int, default=1)
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--prefetch', type=int, default=4)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        zarr_path = Path(tmp_dir, 'synthetic.zarr')
+        make_synthetic_store(zarr_path, args.times, args.levels, args.lat, args.lon)
+
+        naive_sps = naive_loop(zarr_path, args.history, args.lead)
+        print(f'open_zarr + isel loop : {naive_sps:8.2f} samples/s')
+
+        reader = ERA5WindowReader(
+            zarr_path, history_length=args.history, lead_time=args.lead,
+            prefetch=args.prefetch, num_workers=args.workers,
+        )
+        for _ in reader:
+            pass
+        reader.close()
+        print(f'ERA5WindowReader      : {reader.samples_per_second:8.2f} samples/s '
+              f'(cache hits: {reader.cache.hits}, misses: {reader.cache.misses})')
+
+
+if __name__ == '__main__':
+    main()
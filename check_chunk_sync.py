@@ -0,0 +1,82 @@
+# Checks ChunkSync change detection against local and in-memory fsspec stand-ins for the ARCO store
+import json
+import time
+import tempfile
+from pathlib import Path
+
+import fsspec
+import pandas as pd
+
+from utils.chunk_sync import ChunkSync
+
+NUM_TIMES = 4
+TIMES = pd.date_range('2020-01-01', periods=NUM_TIMES, freq='6h')
+ZARRAY = {
+    'shape': [NUM_TIMES, 2, 3, 3], 'chunks': [1, 2, 3, 3], 'dtype': '<f4', 'order': 'C',
+    'compressor': None, 'filters': None, 'fill_value': 'NaN', 'zarr_format': 2,
+}
+SOURCES = {
+    'temperature': [('temperature', list(range(NUM_TIMES)))],
+    # a derived variable reading from two source variables
+    'wind_speed': [('u_component_of_wind', list(range(NUM_TIMES))), ('v_component_of_wind', list(range(NUM_TIMES)))],
+}
+
+
+def make_source_store(fs, root):
+    for source_var in ('temperature', 'u_component_of_wind', 'v_component_of_wind'):
+        fs.makedirs(f"{root}/{source_var}", exist_ok=True)
+        fs.pipe(f"{root}/{source_var}/.zarray", json.dumps(ZARRAY).encode())
+        for time_idx in range(NUM_TIMES):
+            fs.pipe(f"{root}/{source_var}/{time_idx}.0.0.0", b'a' * 72)
+
+
+def rewrite_object(fs, path):
+    # Same size, so only the modification time (mtime, or created for memory://) can tell it changed
+    time.sleep(0.05)
+    fs.pipe(path, b'b' * 72)
+
+
+def check(url, manifest_path, list_fraction):
+    fs, root = fsspec.core.url_to_fs(url)
+    make_source_store(fs, root)
+    chunk_sync = ChunkSync(fs, root, manifest_path, SOURCES, TIMES, list_fraction=list_fraction)
+
+    chunk_sync.save(chunk_sync.fetch_fingerprints())
+    chunk_sync.check_layout(TIMES, list(SOURCES))
+    changed, _ = chunk_sync.changed_chunks()
+    assert changed == [], changed
+
+    rewrite_object(fs, f"{root}/temperature/2.0.0.0")
+    rewrite_object(fs, f"{root}/v_component_of_wind/1.0.0.0")
+    fs.invalidate_cache()
+    changed, fingerprints = chunk_sync.changed_chunks()
+    assert sorted(changed) == [('temperature', 2), ('wind_speed', 1)], changed
+
+    chunk_sync.save(fingerprints)
+    changed, _ = chunk_sync.changed_chunks()
+    assert changed == [], changed
+
+    # A different time selection must be refused instead of rewriting the wrong time slots
+    shifted_sync = ChunkSync(fs, root, manifest_path, SOURCES, TIMES + pd.Timedelta(hours=6), list_fraction=list_fraction)
+    for store_times in (TIMES, TIMES + pd.Timedelta(hours=6)):
+        try:
+            shifted_sync.check_layout(store_times, list(SOURCES))
+        except ValueError:
+            pass
+        else:
+            raise AssertionError('check_layout accepted a different time selection')
+
+    fs.rm(root, recursive=True)
+    mode = 'directory listing' if list_fraction <= 1 else 'per-object info'
+    print(f"{url} ({mode}): OK")
+
+
+def main():
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for list_fraction in (0.1, 2.0):
+            check('memory://arco-stand-in/store.zarr', Path(tmp_dir, 'memory.manifest.json'), list_fraction)
+            check(str(Path(tmp_dir, 'store.zarr')), Path(tmp_dir, 'local.manifest.json'), list_fraction)
+
+
+if __name__ == '__main__':
+    main()
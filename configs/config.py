@@ -2,9 +2,12 @@ from pathlib import Path
 from datetime import datetime
 
 from dataclasses import dataclass
+import pandas as pd
 import hydra
 from omegaconf import DictConfig, OmegaConf
 
+TIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+
 def get_config_name():
     config_name = hydra.core.hydra_config.HydraConfig.get().job.config_name
     return config_name
@@ -20,15 +23,32 @@ class ARCOERA5Config:
     dask_delay: bool
     use_dask_func: bool
 
+    use_write_queue: bool
+    fetch_workers: int
+    writer_workers: int
+    write_queue_size: int
+
+    use_decode_pool: bool
+    decode_workers: int
+    decode_max_blocks: int
+
     zarr_path: Path
+    sync: bool
+    record_fingerprints: bool
 
     start_date: datetime
     end_date: datetime
     timestep_hour: int
     shift_forcing: int
 
+    time_ranges: list[tuple[datetime, datetime]]
+    hours: list[int]
+    timestamps: list[datetime]
+
     variables: list[str]
     forcing_variables: list[str]
+    derived_variables: list[str]
+    drop_derived_inputs: bool
 
     @classmethod
     def from_omegaconf(cls, args:DictConfig) -> 'ARCOERA5Config':
@@ -41,14 +61,56 @@ class ARCOERA5Config:
             
             dask_delay=bool(args.dask.dask_delay),
             use_dask_func=bool(args.dask.use_dask_func),
+
+            use_write_queue=bool(args.write.use_write_queue),
+            fetch_workers=int(args.write.fetch_workers),
+            writer_workers=int(args.write.writer_workers),
+            write_queue_size=int(args.write.queue_size),
+
+            use_decode_pool=bool(args.decode.use_process_pool),
+            decode_workers=int(args.decode.workers),
+            decode_max_blocks=int(args.decode.max_shm_blocks),
             
             zarr_path=Path(args.paths.zarr_dir, args.zarr_name),
+            sync=bool(args.sync),
+            record_fingerprints=bool(args.record_fingerprints),
             
-            start_date=datetime.strptime(args.start_date, '%Y-%m-%d %H:%M:%S'),
-            end_date=datetime.strptime(args.end_date, '%Y-%m-%d %H:%M:%S'),
+            start_date=datetime.strptime(args.start_date, TIME_FORMAT),
+            end_date=datetime.strptime(args.end_date, TIME_FORMAT),
             timestep_hour=args.timestep_hour,
             shift_forcing=args.shift_forcing,
+
+            time_ranges=[(datetime.strptime(start, TIME_FORMAT), datetime.strptime(end, TIME_FORMAT)) for start, end in args.time_ranges],
+            hours=[int(hour) for hour in args.hours],
+            timestamps=[datetime.strptime(timestamp, TIME_FORMAT) for timestamp in args.timestamps],
             
             variables=list(args.variables),
-            forcing_variables=list(args.forcing_variables)
-        )
\ No newline at end of file
+            forcing_variables=list(args.forcing_variables),
+            derived_variables=list(args.derived_variables),
+            drop_derived_inputs=bool(args.drop_derived_inputs),
+        )
+
+    def get_total_times(self) -> pd.DatetimeIndex:
+        """Sorted, unique times to download.
+
+        Every range in `time_ranges` (or `start_date`/`end_date` when empty) is sampled
+        every `timestep_hour` hours and filtered by `hours`; `timestamps` are added as-is.
+        With `timestamps` but no `time_ranges`, only the timestamps are downloaded.
+        """
+        if self.time_ranges:
+            ranges = self.time_ranges
+        elif self.timestamps:
+            ranges = []
+        else:
+            ranges = [(self.start_date, self.end_date)]
+
+        total_times = pd.DatetimeIndex([])
+        for start, end in ranges:
+            total_times = total_times.union(pd.date_range(start=start, end=end, freq=f'{self.timestep_hour}h'))
+        if self.hours:
+            total_times = total_times[total_times.hour.isin(self.hours)]
+        total_times = total_times.union(pd.DatetimeIndex(self.timestamps))
+
+        if len(total_times) == 0:
+            raise ValueError('The time selection is empty')
+        return total_times
@@ -15,7 +15,9 @@ from configs.config import ARCOERA5Config
 from utils.logger import set_logger_path, set_logger
 from utils.xarray_utils import selective_temporal_shift
 from utils.dask_manager import DaskManager
-from utils.gcsfs_utils import lazy_load_original_era5
+from utils.gcsfs_utils import lazy_load_original_era5, get_source_filesystem
+from utils.derived_variables import DERIVED_VARIABLES, get_derived_inputs, add_derived_variables
+from utils.chunk_sync import ChunkSync
 
 
 @hydra.main(version_base=None, config_path="configs", config_name="base")
@@ -25,7 +27,7 @@ def main(args: DictConfig) -> None:
     logging_path = set_logger_path(cfg)
     set_logger(logging_path)
 
-    total_times = pd.date_range(start=cfg.start_date, end=cfg.end_date, freq=f'{cfg.timestep_hour}h')
+    total_times = cfg.get_total_times()
 
     downloader = ERA5Downloader(cfg, total_times)
     downloader._get_dataset_info()
@@ -36,7 +38,10 @@ def main(args: DictConfig) -> None:
     #    sys.exit()
     
     start_time = pd.Timestamp.now()
-    downloader.process_and_store_data()
+    if cfg.sync:
+        downloader.sync_changed_chunks()
+    else:
+        downloader.process_and_store_data()
     end_time = pd.Timestamp.now()
     logging.info(f"Total time taken: {end_time - start_time}")
 
@@ -46,10 +51,16 @@ class ERA5Downloader:
         self.total_times = total_times
         self.full_era5 = lazy_load_original_era5(self.cfg)
         self.sliced_era5 = self._set_era5_dataset()
-        self.dask_manager = DaskManager(cfg, self.sliced_era5, self.total_times)
+        self.sources = self._set_sources()
+        self.dask_manager = DaskManager(cfg, self.sliced_era5, self.total_times, self.sources)
+        self.chunk_sync = self._set_chunk_sync()
 
     def _set_era5_dataset(self):
-        sliced_era5 = self.full_era5[self.cfg.variables + self.cfg.forcing_variables]
+        requested_variables = self.cfg.variables + self.cfg.forcing_variables
+        derived_inputs = get_derived_inputs(self.cfg.derived_variables)
+        extra_inputs = [var for var in derived_inputs if var not in requested_variables]
+
+        sliced_era5 = self.full_era5[requested_variables + extra_inputs]
 
         if self.cfg.shift_forcing > 0 and len(self.cfg.forcing_variables) > 0:
             sliced_era5 = sliced_era5.pipe(
@@ -58,14 +69,42 @@ class ERA5Downloader:
                 time_shift=f'{self.cfg.shift_forcing} hours',
             )
 
+        missing_times = self.total_times.difference(sliced_era5.indexes['time'])
+        if len(missing_times) > 0:
+            raise ValueError(f"Times not available in the source dataset: {list(missing_times)}")
+
+        # Only the selected times are fetched and they are stored densely along `time`
         sliced_era5 = (
             sliced_era5
             .sel(time=self.total_times)
             .chunk({'time': 1, 'latitude': -1, 'longitude': -1, 'level': -1})
         )
 
+        if self.cfg.derived_variables:
+            sliced_era5 = add_derived_variables(sliced_era5, self.cfg.derived_variables)
+            dropped_inputs = derived_inputs if self.cfg.drop_derived_inputs else extra_inputs
+            sliced_era5 = sliced_era5.drop_vars(dropped_inputs)
+
         return sliced_era5
 
+    def _set_sources(self):
+        # Map every stored variable onto the source variables and source time indices it is read from
+        source_times = self.full_era5.indexes['time']
+        sources = {}
+        for var in self.sliced_era5.data_vars:
+            source_vars = DERIVED_VARIABLES[var].inputs if var in self.cfg.derived_variables else (var,)
+            sources[var] = []
+            for source_var in source_vars:
+                shift = self.cfg.shift_forcing if source_var in self.cfg.forcing_variables else 0
+                source_time_indices = source_times.get_indexer(self.total_times - pd.Timedelta(hours=shift))
+                sources[var].append((source_var, source_time_indices))
+        return sources
+
+    def _set_chunk_sync(self):
+        fs, source_root = get_source_filesystem(self.cfg)
+        manifest_path = self.cfg.zarr_path.with_name(self.cfg.zarr_path.name + '.manifest.json')
+        return ChunkSync(fs, source_root, manifest_path, self.sources, self.total_times)
+
     def _get_dataset_info(self):
         self.variables_with_level    = [var for var in self.sliced_era5.data_vars if 'level' in self.sliced_era5[var].dims] 
         self.variables_without_level = [var for var in self.sliced_era5.data_vars if 'level' not in self.sliced_era5[var].dims]
@@ -85,19 +124,24 @@ class ERA5Downloader:
 
     def process_and_store_data(self):
 
+        # Fingerprints are taken before downloading, so revisions published mid-download are picked up by the next sync
+        fingerprints = None
+        if self.cfg.record_fingerprints or self.cfg.sync:
+            fingerprints = self.chunk_sync.fetch_fingerprints()
+
         # for saving the metadata
         if not self.cfg.zarr_path.exists():
-            self.sliced_era5.to_zarr(self.cfg.zarr_path, mode='w', consolidated=True, compute=False)
+            self.sliced_era5.to_zarr(self.cfg.zarr_path, mode='w', consolidated=False, compute=False)
 
         logging.info("Storing sample unit time data for metadata")
-        self.sliced_era5.sel(time=[self.cfg.start_date], drop=False).to_zarr(
-            self.cfg.zarr_path, mode='r+', consolidated=True, compute=True,
+        self.sliced_era5.isel(time=[0], drop=False).to_zarr(
+            self.cfg.zarr_path, mode='r+', consolidated=False, compute=True,
             region={'time': slice(0, 1), 'latitude': slice(None), 'longitude': slice(None), 'level': slice(None)}
         )
         logging.info('Storing sample unit time data done')
 
         logging.info("Downloading and storing data variable-by-variable")
-        for var in self.cfg.variables + self.cfg.forcing_variables:
+        for var in self.sliced_era5.data_vars:
             logging.info(f"Tasking {var}...")
             if var in self.variables_with_level:
                 region_base = {'latitude': slice(None), 'longitude': slice(None), 'level': slice(None)}
@@ -107,8 +151,28 @@ class ERA5Downloader:
             self.dask_manager.process_to_zarr(var, region_base)
 
             #self.dask_manager.process_to_zarr(self.sliced_era5[var].data, url=self.zarr_file_path, component=var, overwrite=True, compute=False, return_stored=False)
+        # also consolidates the metadata, once for the whole store
         self.dask_manager.process_to_zarr_flash()
+        if fingerprints is not None:
+            self.chunk_sync.save(fingerprints)
         logging.info("Downloading and storing data done")
 
+    def sync_changed_chunks(self):
+        if not self.cfg.zarr_path.exists():
+            logging.info("No existing store to sync, downloading everything")
+            self.process_and_store_data()
+            return
+
+        store = xr.open_zarr(self.cfg.zarr_path, chunks=None, consolidated=None)
+        self.chunk_sync.check_layout(store.indexes['time'], list(store.data_vars))
+        store.close()
+
+        changed_chunks, fingerprints = self.chunk_sync.changed_chunks()
+        if changed_chunks:
+            logging.info(f"Re-fetching changed chunks: {changed_chunks}")
+            self.dask_manager.rewrite_chunks(changed_chunks)
+        self.chunk_sync.save(fingerprints)
+        logging.info("Syncing changed chunks done")
+
 if __name__ == '__main__':
     main()
\ No newline at end of file
@@ -0,0 +1,168 @@
+# Description: Change detection for source chunks, used to re-fetch revised ERA5T data
+import json
+import logging
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+
+import pandas as pd
+
+from utils.gcsfs_utils import SourceArrays
+
+# Object metadata fields that change whenever an object is replaced, in order of preference.
+# gcsfs reports generation/crc32c/md5Hash, s3fs and http report ETag.
+FINGERPRINT_FIELDS = ('generation', 'crc32c', 'ETag', 'etag', 'md5Hash')
+
+
+def object_fingerprint(info):
+    for name in FINGERPRINT_FIELDS:
+        if info.get(name):
+            return f"{name}:{info[name]}"
+    # Local and in-memory filesystems only know about size and modification time
+    return f"size:{info.get('size')}:mtime:{info.get('mtime', info.get('created'))}"
+
+
+class ChunkSync:
+    """Tracks the source objects behind every (variable, time index) chunk of the store.
+
+    Args:
+        fs: fsspec filesystem holding the source zarr store.
+        source_root: Path of the source store within `fs`.
+        manifest_path: JSON file where fingerprints are recorded at download time.
+        sources: Maps every stored variable to a list of (source variable, source
+            time indices) pairs, where the indices are aligned with `times`.
+        times: Stored time coordinate the positional time indices refer to.
+        list_fraction: When at least this fraction of a source variable's objects is
+            planned, its directory is listed once instead of querying every object.
+        num_workers: Threads used for per-object metadata requests.
+    """
+
+    def __init__(self, fs, source_root, manifest_path, sources, times, list_fraction=0.1, num_workers=16):
+        self.fs = fs
+        self.source_root = source_root.rstrip('/')
+        self.manifest_path = Path(manifest_path)
+        self.sources = sources
+        self.times = pd.DatetimeIndex(times)
+        self.list_fraction = list_fraction
+        self.num_workers = num_workers
+        self.source_arrays = SourceArrays(fs, source_root)
+
+    def _planned_keys(self):
+        planned = {}
+        for var, var_sources in self.sources.items():
+            for time_idx in range(len(var_sources[0][1])):
+                planned[(var, time_idx)] = [
+                    key
+                    for source_var, source_time_indices in var_sources
+                    for key in self.source_arrays.chunk_keys(source_var, int(source_time_indices[time_idx]))
+                ]
+        return planned
+
+    def _object_fingerprints(self, keys):
+        fingerprints = {}
+        keys_by_var = {}
+        for key in keys:
+            keys_by_var.setdefault(key.rsplit('/', 1)[0], []).append(key)
+
+        single_keys = []
+        for var_dir, var_keys in keys_by_var.items():
+            num_objects = self.source_arrays.num_objects(var_dir.rsplit('/', 1)[1])
+            if len(var_keys) >= self.list_fraction * num_objects:
+                listing = {info['name'].rstrip('/'): info for info in self.fs.ls(var_dir, detail=True)}
+                # listings of ARCO variables hold hundreds of thousands of entries, don't keep them cached
+                self.fs.invalidate_cache(var_dir)
+                for key in var_keys:
+                    info = listing.get(key)
+                    fingerprints[key] = object_fingerprint(info) if info is not None else None
+            else:
+                single_keys.extend(var_keys)
+
+        def _info(key):
+            try:
+                return key, object_fingerprint(self.fs.info(key))
+            except FileNotFoundError:
+                return key, None
+
+        with ThreadPoolExecutor(max_workers=self.num_workers) as executor:
+            fingerprints.update(executor.map(_info, single_keys))
+        return fingerprints
+
+    def fetch_fingerprints(self):
+        """Returns the current fingerprint of every planned chunk, keyed by (variable, time index)."""
+        planned = self._planned_keys()
+        unique_keys = {key for keys in planned.values() for key in keys}
+        logging.info(f"Fetching metadata of {len(unique_keys)} source objects for {len(planned)} chunks")
+        object_fingerprints = self._object_fingerprints(unique_keys)
+        return {
+            chunk: '|'.join(str(object_fingerprints[key]) for key in keys)
+            for chunk, keys in planned.items()
+        }
+
+    def save(self, fingerprints):
+        manifest = {}
+        for (var, time_idx), fingerprint in fingerprints.items():
+            manifest.setdefault(var, {})[str(time_idx)] = fingerprint
+        with open(self.manifest_path, 'w') as f:
+            json.dump({
+                'source': self.source_root,
+                'times': [time.isoformat() for time in self.times],
+                'variables': sorted(self.sources),
+                'chunks': manifest,
+            }, f)
+        logging.info(f"Saved fingerprints of {len(fingerprints)} chunks to {self.manifest_path}")
+
+    def _read_manifest(self):
+        if not self.manifest_path.exists():
+            return None
+        with open(self.manifest_path) as f:
+            return json.load(f)
+
+    def check_layout(self, store_times, store_variables):
+        """Raises a ValueError unless the store and the manifest match the planned times and variables.
+
+        Chunks are tracked by positional time index, so any other time selection
+        would rewrite data into the wrong time slots.
+        """
+        if not pd.DatetimeIndex(store_times).equals(self.times):
+            raise ValueError(
+                f"The time coordinate of the existing store ({len(store_times)} times) does not match the "
+                f"configured time selection ({len(self.times)} times); sync needs the same selection as the download"
+            )
+        missing_variables = set(self.sources) - set(store_variables)
+        if missing_variables:
+            raise ValueError(f"Variables missing from the existing store: {sorted(missing_variables)}")
+
+        manifest = self._read_manifest()
+        if manifest is None:
+            return
+        if manifest['source'] != self.source_root:
+            raise ValueError(f"{self.manifest_path} was recorded for source {manifest['source']}, not {self.source_root}")
+        if not pd.DatetimeIndex(manifest['times']).equals(self.times):
+            raise ValueError(f"{self.manifest_path} was recorded for a different time selection")
+        if manifest['variables'] != sorted(self.sources):
+            raise ValueError(
+                f"{self.manifest_path} was recorded for variables {manifest['variables']}, "
+                f"not {sorted(self.sources)}"
+            )
+
+    def load(self):
+        manifest = self._read_manifest()
+        if manifest is None:
+            return {}
+        return {
+            (var, int(time_idx)): fingerprint
+            for var, var_manifest in manifest['chunks'].items()
+            for time_idx, fingerprint in var_manifest.items()
+        }
+
+    def changed_chunks(self):
+        """Returns the chunks whose source objects differ from the manifest, and the current fingerprints.
+
+        Chunks missing from the manifest count as changed.
+        """
+        recorded = self.load()
+        if not recorded:
+            logging.warning(f"No fingerprints recorded in {self.manifest_path}, every chunk counts as changed")
+        current = self.fetch_fingerprints()
+        changed = [chunk for chunk, fingerprint in current.items() if recorded.get(chunk) != fingerprint]
+        logging.info(f"{len(changed)} of {len(current)} chunks changed since the last download")
+        return changed, current
@@ -1,47 +1,159 @@
 import xarray as xr
 import dask
 import dask.array as da
+import zarr
 import logging
+from concurrent.futures import ThreadPoolExecutor, wait
+
+from utils.write_queue import WriteBehindQueue
+from utils.decode_pool import DecodePool
 
 class DaskManager:
 
-    def __init__(self, cfg, sliced_era5, total_times):
+    def __init__(self, cfg, sliced_era5, total_times, sources=None):
         self.cfg = cfg
         self.sliced_era5 = sliced_era5
         self.total_times = total_times
+        # var -> [(source variable, source time indices)], used by the decode pool
+        self.sources = sources or {}
 
         self.dask_delay = self.cfg.dask_delay
         self.zarr_path  = self.cfg.zarr_path
         
-        if self.cfg.use_dask_func:
+        if self.cfg.use_write_queue:
+            self.process_to_zarr = self.process_to_zarr_by_queue
+        elif self.cfg.use_dask_func:
             self.process_to_zarr = self.process_to_zarr_by_dask
         else:
             self.process_to_zarr = self.process_to_zarr_by_xarray
 
         self.delayed_tasks = []
 
+        self.write_queue = None
+        self.decode_pool = None
+        self.fetch_executor = None
+        self.fetch_futures = []
+
+        # Derived variables and their stored inputs are fetched together per time step,
+        # so the inputs are read once for all of them
+        self.grouped_variables = set()
+        for var in self.cfg.derived_variables:
+            self.grouped_variables.add(var)
+            self.grouped_variables.update(
+                source_var for source_var, _ in self.sources.get(var, []) if source_var in self.sliced_era5.data_vars
+            )
+        self.grouped_fetches = {}
+
     def process_to_zarr_by_xarray(self, var, region_base):
         for time_idx, time in enumerate(self.total_times):
             if time_idx == 0: continue
             region = region_base.copy()
             region['time'] = slice(time_idx, time_idx+1)
-            nullspace = xr.open_zarr(self.zarr_file_path, consolidated=True).isnull()
+            nullspace = xr.open_zarr(self.zarr_path, consolidated=False).isnull()
             if nullspace[var].sel(time=[time], drop=False).any():
-                dask_delay = self.sliced_era5[var].sel(time=[time], drop=False).to_zarr(self.zarr_file_path, mode='r+', consolidated=True, compute=False, region=region)
+                dask_delay = self.sliced_era5[var].sel(time=[time], drop=False).to_zarr(self.zarr_path, mode='r+', consolidated=False, compute=False, region=region)
             
                 if self.dask_delay:
                     self.delayed_tasks.append(dask_delay)
 
     def process_to_zarr_by_dask(self, var, region_base):
-        delayed_task = da.to_zarr(arr=self.sliced_era5[var].data, \
-                                  url=self.zarr_path, component=var, overwrite=True, compute=False, return_stored=False)
+        # Store into the array created with the metadata; recreating it (to_zarr with overwrite=True)
+        # would drop its attributes, including the _ARRAY_DIMENSIONS xarray needs to open the store.
+        # Dask chunks match the zarr chunks (one time step each), so no lock is needed.
+        target = zarr.open_array(str(self.zarr_path), path=var, mode='r+')
+        delayed_task = da.store(self.sliced_era5[var].data, target, lock=False, compute=False)
         if self.dask_delay:
             self.delayed_tasks.append(delayed_task)
 
+    def process_to_zarr_by_queue(self, var, region_base):
+        for time_idx in range(1, len(self.total_times)):
+            self._submit_fetch(var, time_idx)
+
+    def rewrite_chunks(self, chunks):
+        # Always goes through the write queue: only individual (var, time_idx) chunks are rewritten
+        for var, time_idx in chunks:
+            self._submit_fetch(var, time_idx)
+        self.process_to_zarr_flash()
+
+    def _submit_fetch(self, var, time_idx):
+        # Network fetches run on their own pool and hand decoded chunks to the
+        # write queue, so fetching and disk I/O overlap instead of alternating.
+        if self.write_queue is None:
+            self.write_queue = WriteBehindQueue(self.zarr_path, self.cfg.writer_workers, self.cfg.write_queue_size)
+            self.fetch_executor = ThreadPoolExecutor(max_workers=self.cfg.fetch_workers, thread_name_prefix='era5-fetch')
+            if self.cfg.use_decode_pool:
+                self.decode_pool = DecodePool(self.cfg, self.cfg.decode_workers, self.cfg.decode_max_blocks)
+
+        if var in self.grouped_variables:
+            # submitted in process_to_zarr_flash, once every variable of the time step is known
+            self.grouped_fetches.setdefault(time_idx, []).append(var)
+        else:
+            self.fetch_futures.append(self.fetch_executor.submit(self._fetch_to_queue, var, time_idx))
+
+    def _submit_grouped_fetches(self):
+        for time_idx, group in self.grouped_fetches.items():
+            self.fetch_futures.append(self.fetch_executor.submit(self._fetch_step_to_queue, group, time_idx))
+        self.grouped_fetches = {}
+
+    def _fetch_step_to_queue(self, variables, time_idx):
+        # One compute over all variables shares the input chunks between the derived variables
+        step = self.sliced_era5[variables].isel(time=time_idx).compute(scheduler='synchronous')
+        for var in variables:
+            self.write_queue.put(var, time_idx, step[var].values)
+
+    def _decodable_source(self, var):
+        # Raw chunks can only be decoded for variables stored as-is from a single source variable
+        var_sources = self.sources.get(var, [])
+        if self.decode_pool is None or len(var_sources) != 1 or var_sources[0][0] != var:
+            return None
+        if not self.decode_pool.eligible(var, self.sliced_era5[var].dtype):
+            return None
+        return var_sources[0]
+
+    def _fetch_to_queue(self, var, time_idx):
+        source = self._decodable_source(var)
+        if source is not None:
+            source_var, source_time_indices = source
+            data, release = self.decode_pool.decode(source_var, int(source_time_indices[time_idx]))
+            try:
+                self.write_queue.put(var, time_idx, data, on_written=release)
+            except Exception:
+                data = None
+                release()
+                raise
+            return
+
+        data = self.sliced_era5[var].isel(time=time_idx).compute(scheduler='synchronous').values
+        self.write_queue.put(var, time_idx, data)
+
     def process_to_zarr_flash(self):
+        if self.write_queue is not None:
+            self._submit_grouped_fetches()
+            logging.info(f"Waiting for {len(self.fetch_futures)} queued chunk fetches...")
+            fetch_futures, self.fetch_futures = self.fetch_futures, []
+            try:
+                wait(fetch_futures)
+                self.fetch_executor.shutdown(wait=True)
+            finally:
+                fetch_errors = [future.exception() for future in fetch_futures if future.done() and future.exception() is not None]
+                write_queue, self.write_queue = self.write_queue, None
+                decode_pool, self.decode_pool = self.decode_pool, None
+                try:
+                    # close() consolidates the metadata once all chunks are on disk
+                    write_queue.close()
+                finally:
+                    if decode_pool is not None:
+                        decode_pool.close()
+            if fetch_errors:
+                raise fetch_errors[0]
+            return
+
         if self.dask_delay:
             logging.info("Computing all delayed tasks... Setting Logger level to DEBUG for more details")
             logging.getLogger().setLevel(logging.DEBUG)
             dask.compute(*self.delayed_tasks)
             self.delayed_tasks = []
-            logging.info("All delayed tasks are computed")
\ No newline at end of file
+            logging.info("All delayed tasks are computed")
+
+        zarr.consolidate_metadata(str(self.zarr_path))
+        logging.info("Metadata consolidated")
\ No newline at end of file
@@ -0,0 +1,127 @@
+# Description: Process-pool decode stage writing source chunks into shared memory
+import math
+import threading
+import multiprocessing
+from multiprocessing import shared_memory
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import numcodecs
+
+from utils.gcsfs_utils import get_source_filesystem, SourceArrays
+
+
+def _fill_value(zarray):
+    if zarray['fill_value'] is None:
+        return np.zeros((), dtype=zarray['dtype'])
+    return np.array(zarray['fill_value'], dtype=zarray['dtype'])
+
+
+def _decode_chunk(raw, zarray, shm_name):
+    """Runs in a worker process: decompresses `raw` straight into the shared memory block `shm_name`."""
+    shm = shared_memory.SharedMemory(name=shm_name)
+    out = None
+    try:
+        out = np.ndarray(zarray['chunks'], dtype=zarray['dtype'], buffer=shm.buf, order=zarray['order'])
+        fill_value = _fill_value(zarray)
+
+        if raw is None:
+            out[...] = fill_value
+        else:
+            filters = [numcodecs.get_codec(dict(config)) for config in zarray['filters'] or []]
+            compressor = numcodecs.get_codec(dict(zarray['compressor'])) if zarray['compressor'] else None
+            if compressor is not None and not filters:
+                compressor.decode(raw, out=out)
+            else:
+                buf = compressor.decode(raw) if compressor is not None else raw
+                for codec in reversed(filters):
+                    buf = codec.decode(buf)
+                out[...] = np.frombuffer(buf, dtype=zarray['dtype']).reshape(zarray['chunks'], order=zarray['order'])
+
+        # Match xarray's decoding, which masks the fill value of float variables as NaN.
+        # A null fill_value sets no _FillValue in xarray, so nothing is masked then.
+        if zarray['fill_value'] is not None and out.dtype.kind == 'f' and not np.isnan(fill_value):
+            out[out == fill_value] = np.nan
+    finally:
+        # the view has to be dropped before the block can be closed
+        out = None
+        shm.close()
+
+
+class DecodePool:
+    """Decodes raw source chunks in worker processes, outside the GIL of the fetch threads.
+
+    The parent allocates one shared memory block per chunk, workers decompress into
+    it and the parent hands a zero-copy view to the writer, so decoded arrays are
+    never pickled. At most `max_blocks` blocks are alive at once, since every block
+    holds a full chunk in /dev/shm. Only source variables whose chunks hold a single
+    time step and span all other dimensions, without CF encoding beyond the fill
+    value, are eligible; everything else goes through xarray.
+    """
+
+    # CF attributes xarray would decode, which the raw decode does not apply
+    CF_ENCODING_ATTRS = ('scale_factor', 'add_offset', 'missing_value')
+
+    def __init__(self, cfg, num_workers, max_blocks):
+        self.fs, source_root = get_source_filesystem(cfg)
+        self.source_arrays = SourceArrays(self.fs, source_root)
+        self._blocks = threading.BoundedSemaphore(max_blocks)
+        # spawn, since forking the multi-threaded fetch stage is unsafe
+        self.executor = ProcessPoolExecutor(max_workers=num_workers, mp_context=multiprocessing.get_context('spawn'))
+
+    def eligible(self, source_var, dtype):
+        zarray = self.source_arrays.zarray(source_var)
+        zattrs = self.source_arrays.zattrs(source_var)
+        return (
+            zarray['chunks'][0] == 1
+            and list(zarray['chunks'][1:]) == list(zarray['shape'][1:])
+            and np.dtype(zarray['dtype']) == np.dtype(dtype)
+            and not any(attr in zattrs for attr in self.CF_ENCODING_ATTRS)
+        )
+
+    def decode(self, source_var, source_time_idx):
+        """Fetches and decodes one time step of `source_var`.
+
+        Returns the decoded array, a view on shared memory, and a callback that
+        releases the shared memory once the array is no longer used.
+        """
+        zarray = self.source_arrays.zarray(source_var)
+        (key,) = self.source_arrays.chunk_keys(source_var, source_time_idx)
+        try:
+            raw = self.fs.cat(key)
+        except FileNotFoundError:
+            raw = None
+
+        nbytes = math.prod(zarray['chunks']) * np.dtype(zarray['dtype']).itemsize
+        # blocks until the writer released enough earlier blocks
+        self._blocks.acquire()
+        try:
+            shm = shared_memory.SharedMemory(create=True, size=nbytes)
+        except BaseException:
+            self._blocks.release()
+            raise
+        try:
+            self.executor.submit(_decode_chunk, raw, zarray, shm.name).result()
+        except BaseException:
+            shm.unlink()
+            shm.close()
+            self._blocks.release()
+            raise
+
+        data = np.ndarray(zarray['chunks'], dtype=zarray['dtype'], buffer=shm.buf, order=zarray['order'])[0]
+
+        def release():
+            # Unlink first so the block is freed even if a view on it is still alive,
+            # in which case closing the mapping is left to garbage collection.
+            shm.unlink()
+            try:
+                shm.close()
+            except BufferError:
+                pass
+            finally:
+                self._blocks.release()
+
+        return data, release
+
+    def close(self):
+        self.executor.shutdown(wait=True)
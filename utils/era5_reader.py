@@ -0,0 +1,189 @@
+# Description: Windowed reader over the zarr store produced by get_era5.py
+import time
+import logging
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import xarray as xr
+
+
+class ChunkCache:
+    """Thread-safe LRU cache of decoded (variable, time index) chunks.
+
+    Entries are futures, so a chunk that is already being loaded by the
+    prefetcher is awaited instead of being read a second time. Failed reads are
+    dropped, so the chunk is read again by the next window that needs it.
+    """
+
+    def __init__(self, max_chunks):
+        self.max_chunks = max_chunks
+        self._entries = OrderedDict()
+        # reentrant, since the done callback runs right away for futures that already finished
+        self._lock = threading.RLock()
+        self.hits = 0
+        self.misses = 0
+
+    def get_or_submit(self, key, executor, load_fn):
+        with self._lock:
+            future = self._entries.get(key)
+            if future is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return future
+            self.misses += 1
+            future = executor.submit(load_fn, *key)
+            self._entries[key] = future
+            while len(self._entries) > self.max_chunks:
+                self._entries.popitem(last=False)
+            future.add_done_callback(lambda done, key=key: self._drop_failed(key, done))
+            return future
+
+    def _drop_failed(self, key, future):
+        if future.cancelled() or future.exception() is not None:
+            with self._lock:
+                if self._entries.get(key) is future:
+                    del self._entries[key]
+
+
+class ERA5WindowReader:
+    """Yields (inputs, targets) windows from a store written by ERA5Downloader.
+
+    The store is chunked with one time step per chunk, so every (variable, time
+    index) pair maps onto exactly one chunk. For a sample anchored at time index
+    `t`, inputs cover `t - history_length + 1 ... t` and targets cover
+    `t + lead_time ... t + lead_time + target_length - 1`. Lead time and lengths
+    are counted in time steps of `timestep_hour`. Sparse selections are stored
+    densely, so windows whose times are not evenly `timestep_hour` apart (e.g.
+    crossing from one season to the next) are skipped.
+
+    Args:
+        zarr_path: Path to the zarr store.
+        input_variables: Variables returned in `inputs`. Defaults to all.
+        target_variables: Variables returned in `targets`. Defaults to inputs.
+        history_length: Number of input time steps per sample.
+        lead_time: Steps between the last input and the first target.
+        target_length: Number of target time steps per sample.
+        stride: Steps between consecutive sample anchors.
+        prefetch: Number of upcoming samples whose chunks are requested ahead.
+        num_workers: Threads used for reading chunks.
+        cache_chunks: Maximum number of decoded chunks kept in memory.
+        timestep_hour: Expected spacing of the times in a window. Defaults to the
+            smallest spacing in the store.
+    """
+
+    def __init__(
+        self,
+        zarr_path,
+        input_variables=None,
+        target_variables=None,
+        history_length=2,
+        lead_time=1,
+        target_length=1,
+        stride=1,
+        prefetch=4,
+        num_workers=4,
+        cache_chunks=None,
+        timestep_hour=None,
+    ):
+        if history_length < 1 or target_length < 1 or lead_time < 1 or stride < 1:
+            raise ValueError('history_length, target_length, lead_time and stride must be positive')
+
+        self.dataset = xr.open_zarr(zarr_path, chunks=None, consolidated=None)
+        self.input_variables  = list(input_variables or self.dataset.data_vars)
+        self.target_variables = list(target_variables or self.input_variables)
+        self.history_length = history_length
+        self.lead_time      = lead_time
+        self.target_length  = target_length
+        self.stride   = stride
+        self.prefetch = prefetch
+
+        self.time_values = self.dataset['time'].values
+        anchors = np.arange(
+            history_length - 1,
+            len(self.time_values) - lead_time - target_length + 1,
+            stride,
+        )
+
+        # Keep only windows without gaps: count the irregular steps up to every time index
+        time_diffs = np.diff(self.time_values)
+        if timestep_hour is not None:
+            self.time_step = np.timedelta64(timestep_hour, 'h')
+        else:
+            self.time_step = time_diffs.min() if len(time_diffs) > 0 else None
+        num_irregular = np.concatenate([[0], np.cumsum(time_diffs != self.time_step)])
+        window_start = anchors - history_length + 1
+        window_end   = anchors + lead_time + target_length - 1
+        self.anchors = anchors[num_irregular[window_end] == num_irregular[window_start]]
+        if len(self.anchors) < len(anchors):
+            logging.info(f"Skipping {len(anchors) - len(self.anchors)} windows that are not evenly spaced by {self.time_step}")
+
+        # By default keep enough chunks for the window in flight and all prefetched ones.
+        if cache_chunks is None:
+            steps = history_length + lead_time + target_length + (prefetch + 1) * stride
+            cache_chunks = steps * len(set(self.input_variables) | set(self.target_variables))
+        self.cache = ChunkCache(cache_chunks)
+        self.executor = ThreadPoolExecutor(max_workers=num_workers, thread_name_prefix='era5-reader')
+
+        self.num_samples  = 0
+        self.elapsed_time = 0.0
+
+    def __len__(self):
+        return len(self.anchors)
+
+    def _load_chunk(self, var, time_idx):
+        # chunks=None keeps the variable lazily indexed, so only this chunk is read
+        return self.dataset[var].variable[time_idx].values
+
+    def _window_indices(self, anchor):
+        input_idx  = range(anchor - self.history_length + 1, anchor + 1)
+        target_idx = range(anchor + self.lead_time, anchor + self.lead_time + self.target_length)
+        return input_idx, target_idx
+
+    def _request(self, anchor):
+        input_idx, target_idx = self._window_indices(anchor)
+        inputs  = {var: [self.cache.get_or_submit((var, int(i)), self.executor, self._load_chunk) for i in input_idx]
+                   for var in self.input_variables}
+        targets = {var: [self.cache.get_or_submit((var, int(i)), self.executor, self._load_chunk) for i in target_idx]
+                   for var in self.target_variables}
+        return inputs, targets
+
+    @staticmethod
+    def _gather(futures):
+        return {var: np.stack([future.result() for future in var_futures]) for var, var_futures in futures.items()}
+
+    def __iter__(self):
+        self.num_samples = 0
+        start_time = time.perf_counter()
+        pending = OrderedDict()
+        for i, anchor in enumerate(self.anchors):
+            for ahead in self.anchors[i:i + self.prefetch + 1]:
+                if ahead not in pending:
+                    pending[ahead] = self._request(ahead)
+            inputs, targets = pending.pop(anchor)
+
+            sample = (self._gather(inputs), self._gather(targets))
+            self.num_samples += 1
+            self.elapsed_time = time.perf_counter() - start_time
+            yield sample
+
+        logging.info(
+            f"Read {self.num_samples} samples at {self.samples_per_second:.2f} samples/s "
+            f"(cache hits: {self.cache.hits}, misses: {self.cache.misses})"
+        )
+
+    @property
+    def samples_per_second(self):
+        if self.elapsed_time == 0:
+            return 0.0
+        return self.num_samples / self.elapsed_time
+
+    def time_window(self, anchor):
+        """Returns the input and target time coordinates of the sample at `anchor`."""
+        input_idx, target_idx = self._window_indices(anchor)
+        return self.time_values[list(input_idx)], self.time_values[list(target_idx)]
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+        self.dataset.close()
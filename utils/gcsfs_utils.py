@@ -1,9 +1,56 @@
 # Description: Utility functions for interacting with GCSFS
-import gcsfs
+import json
+import math
+import itertools
+
+import fsspec
 import xarray as xr
 
+def get_source_filesystem(cfg):
+    # Non-gs:// objects (e.g. local or memory:// copies of the store) are opened with plain fsspec
+    storage_options = {'token': cfg.gcsfs_token} if cfg.gcsfs_object.startswith('gs://') else {}
+    fs, source_root = fsspec.core.url_to_fs(cfg.gcsfs_object, **storage_options)
+    return fs, source_root
+
 def lazy_load_original_era5(cfg):
-    gcs = gcsfs.GCSFileSystem(token=cfg.gcsfs_token)
-    gcsfs_path = cfg.gcsfs_object
-    full_era5 = xr.open_zarr(gcs.get_mapper(gcsfs_path), chunks=None, consolidated=None)
-    return full_era5
\ No newline at end of file
+    fs, source_root = get_source_filesystem(cfg)
+    full_era5 = xr.open_zarr(fs.get_mapper(source_root), chunks=None, consolidated=None)
+    return full_era5
+
+
+class SourceArrays:
+    """Cached zarr v2 metadata and chunk object paths of the variables in the source store."""
+
+    def __init__(self, fs, source_root):
+        self.fs = fs
+        self.source_root = source_root.rstrip('/')
+        self._zarray = {}
+        self._zattrs = {}
+
+    def zarray(self, source_var):
+        if source_var not in self._zarray:
+            self._zarray[source_var] = json.loads(self.fs.cat(f"{self.source_root}/{source_var}/.zarray"))
+        return self._zarray[source_var]
+
+    def zattrs(self, source_var):
+        if source_var not in self._zattrs:
+            try:
+                self._zattrs[source_var] = json.loads(self.fs.cat(f"{self.source_root}/{source_var}/.zattrs"))
+            except FileNotFoundError:
+                self._zattrs[source_var] = {}
+        return self._zattrs[source_var]
+
+    def num_objects(self, source_var):
+        zarray = self.zarray(source_var)
+        return math.prod(math.ceil(size / chunk) for size, chunk in zip(zarray['shape'], zarray['chunks']))
+
+    def chunk_keys(self, source_var, source_time_idx):
+        """Object paths of every source chunk overlapping one time step of `source_var`."""
+        zarray = self.zarray(source_var)
+        separator = zarray.get('dimension_separator') or '.'
+        time_chunk = source_time_idx // zarray['chunks'][0]
+        other_chunks = [range(math.ceil(size / chunk)) for size, chunk in zip(zarray['shape'][1:], zarray['chunks'][1:])]
+        return [
+            f"{self.source_root}/{source_var}/" + separator.join(str(i) for i in (time_chunk, *chunk_idx))
+            for chunk_idx in itertools.product(*other_chunks)
+        ]
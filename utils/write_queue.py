@@ -0,0 +1,79 @@
+# Description: Write-behind stage that drains decoded chunks to the local zarr store
+import queue
+import logging
+import threading
+
+import zarr
+
+
+class WriteBehindQueue:
+    """Bounded queue of (variable, time index, array) items drained by writer threads.
+
+    Producers block on `put` once `max_queue_size` chunks are waiting, which keeps
+    memory bounded while network fetching and disk writes overlap. Metadata is
+    consolidated once in `close`, instead of on every region write.
+    """
+
+    def __init__(self, zarr_path, num_writers=2, max_queue_size=16):
+        # With zarr 2 (see README) the path opens a DirectoryStore, which writes every chunk to a
+        # temporary file and renames it into place, so a crashed run never leaves a partial chunk.
+        # zarr 3's LocalStore does not, hence the zarr<3 requirement.
+        self.zarr_path = str(zarr_path)
+        self.group = zarr.open_group(self.zarr_path, mode='r+')
+        self.queue = queue.Queue(maxsize=max_queue_size)
+
+        self.num_written = 0
+        self._lock = threading.Lock()
+        self._error = None
+        self._writers = [
+            threading.Thread(target=self._drain, name=f'zarr-writer-{i}', daemon=True)
+            for i in range(num_writers)
+        ]
+        for writer in self._writers:
+            writer.start()
+
+    def put(self, var, time_idx, data, on_written=None):
+        """Queues `data` for writing. `on_written` is called once the writer no longer references it.
+
+        If `put` raises, `data` was not queued and `on_written` is left to the caller.
+        """
+        if self._error is not None:
+            raise self._error
+        self.queue.put((var, time_idx, data, on_written))
+
+    def _drain(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                self.queue.task_done()
+                return
+            var, time_idx, data, on_written = item
+            try:
+                if self._error is None:
+                    self.group[var][time_idx] = data
+                    with self._lock:
+                        self.num_written += 1
+                    logging.debug(f"Stored {var} at time index {time_idx}")
+            except Exception as e:
+                logging.error(f"Failed to store {var} at time index {time_idx}: {e}")
+                self._error = e
+            finally:
+                # drop references first, on_written may release the buffer behind `data`
+                item = data = None
+                if on_written is not None:
+                    try:
+                        on_written()
+                    except Exception as e:
+                        logging.error(f"Failed to release {var} at time index {time_idx}: {e}")
+                self.queue.task_done()
+
+    def close(self):
+        for _ in self._writers:
+            self.queue.put(None)
+        for writer in self._writers:
+            writer.join()
+        if self._error is not None:
+            raise self._error
+
+        zarr.consolidate_metadata(self.zarr_path)
+        logging.info(f"Write queue drained: {self.num_written} chunks stored, metadata consolidated")